@@ -2,33 +2,60 @@
 
 import argparse # Add the argparse import
 
-from gnucash import Session, GncPrice, GncNumeric
-
-import gnucash.gnucash_core_c
-from gnucash.function_class import ClassFromFunctions
-
 import datetime
 
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from contextlib import contextmanager
+import csv
 from functools import lru_cache
 import json 
+import math
+import os
 import sys
-from os.path import isfile
+import warnings
+from os.path import isfile, splitext
 # from os import isatty
 
-# <MONKEY-PATCH>
-# Monkey patch for GnuCash Python bindings 
-# as the Python class GncPrice does not implement 
-# a correct __init__ method by default
-
-
-def create_price(self, book=None, instance=None):
-    if instance:
-        price_instance = instance
+if os.environ.get("GNUCASH_BINDINGS") == "fake":
+    # in-memory stand-in for the bindings (see gnucash_fake.py)
+    from gnucash_fake import Session, GncPrice, GncNumeric
+    from gnucash_fake import qof_event_suspend, qof_event_resume
+    QOF_EVENTS_SUSPENDABLE = True
+else:
+    from gnucash import Session, GncPrice, GncNumeric
+
+    import gnucash.gnucash_core_c
+    from gnucash.function_class import ClassFromFunctions
+
+    # <MONKEY-PATCH>
+    # Monkey patch for GnuCash Python bindings 
+    # as the Python class GncPrice does not implement 
+    # a correct __init__ method by default
+
+    def create_price(self, book=None, instance=None):
+        if instance:
+            price_instance = instance
+        else:
+            price_instance = gnucash.gnucash_core_c.gnc_price_create(book.get_instance())
+        ClassFromFunctions.__init__(self, instance=price_instance)
+    GncPrice.__init__ = create_price
+    # </MONKEY-PATCH>
+
+    # qof_event_suspend/qof_event_resume are not exported by every build
+    # of the bindings: in that case the events are not suspended
+    # and bulk_insert warns about it (see QOF_EVENTS_SUSPENDABLE)
+    QOF_EVENTS_SUSPENDABLE = (
+        hasattr(gnucash.gnucash_core_c, "qof_event_suspend") and
+        hasattr(gnucash.gnucash_core_c, "qof_event_resume"))
+    if QOF_EVENTS_SUSPENDABLE:
+        from gnucash.gnucash_core_c import qof_event_suspend, qof_event_resume
     else:
-        price_instance = gnucash.gnucash_core_c.gnc_price_create(book.get_instance())
-    ClassFromFunctions.__init__(self, instance=price_instance)
-GncPrice.__init__ = create_price
-# </MONKEY-PATCH>
+        def qof_event_suspend():
+            pass
+        def qof_event_resume():
+            pass
 
 
 @lru_cache(maxsize=32)
@@ -96,18 +123,168 @@ def get_commodity_by_fullname(commodity_table, fullname, namespace_name=""):
     return None
 
 
+def normalize_fullname(fullname):
+    "Returns the fullname in lower case, with punctuation removed and whitespace collapsed"
+    s = "".join(ch if ch.isalnum() else " " for ch in fullname.casefold())
+    return " ".join(s.split())
+
+
+def get_trigrams(s):
+    "Returns the set of the trigrams of the string (padded with a space at both ends)"
+    s = " " + s + " "
+    return {s[i:i+3] for i in range(len(s) - 2)}
+
+
+class FullnameIndex:
+    """Normalized and fuzzy index of the commodity fullnames
+
+    Built once from all the commodities of the commodity table:
+    a map from the fullname to the commodities, a map from the normalized
+    fullname to the commodities and an inverted index from each trigram
+    of the normalized fullname to the commodities containing it,
+    sorted by number of trigrams.
+    The similarity of two names is the Jaccard index of their trigram sets;
+    a threshold of 1 matches only the names equal after normalization.
+
+    The fuzzy candidates are pruned by length filtering (a name with c
+    trigrams can reach the threshold t for a query with q trigrams only if
+    t*q <= c <= q/t) and by prefix filtering (it must share at least
+    ceil(t*q) trigrams with the query, so it contains at least one of
+    the q - ceil(t*q) + 1 rarest query trigrams), see find."""
+
+    # extra rare query trigrams scanned by the prefix filtering:
+    # the names must hit PREFIX_EXTRA + 1 of them, so fewer are verified
+    PREFIX_EXTRA = 8
+
+    def __init__(self, commodity_table, threshold=1.0):
+        if not (0 < threshold <= 1):
+            raise ValueError("Similarity threshold must be in (0, 1], got {0}".format(threshold))
+        self.threshold = threshold
+
+        # entries: list of (commodity, namespace name, number of trigrams, trigrams)
+        self.entries = []
+        self.by_fullname = dict()
+        self.by_normalized = dict()
+        self.by_trigram = dict()
+
+        for namespace in commodity_table.get_namespaces_list():
+            namespace_name = namespace.get_name()
+            for commodity in commodity_table.get_commodities(namespace_name):
+                fullname = commodity.get_fullname()
+                if not fullname:
+                    continue
+                normalized = normalize_fullname(fullname)
+                trigrams = get_trigrams(normalized)
+                idx = len(self.entries)
+                self.entries.append((commodity, namespace_name, len(trigrams), frozenset(trigrams)))
+                self.by_fullname.setdefault(fullname, []).append(idx)
+                self.by_normalized.setdefault(normalized, []).append(idx)
+                for t in trigrams:
+                    self.by_trigram.setdefault(t, []).append(idx)
+
+        # posting lists sorted by number of trigrams, with the parallel
+        # list of the numbers of trigrams to select a length range by bisect
+        for t, idxs in self.by_trigram.items():
+            idxs.sort(key=lambda idx: self.entries[idx][2])
+            self.by_trigram[t] = ([self.entries[idx][2] for idx in idxs], idxs)
+
+    def find(self, fullname, namespace_name=""):
+        """Returns the list of the best matching commodities for the fullname
+
+        The commodities with the same fullname are returned, if any;
+        otherwise the ones with the same normalized fullname, if any;
+        otherwise the most similar ones above the threshold.
+        The list is empty if no commodity matches,
+        and has more than one commodity if the match is ambiguous."""
+
+        def in_namespace(idx):
+            return namespace_name == "" or self.entries[idx][1] == namespace_name
+
+        found = [idx for idx in self.by_fullname.get(fullname, []) if in_namespace(idx)]
+        if found:
+            return [self.entries[idx][0] for idx in found]
+
+        normalized = normalize_fullname(fullname)
+        if normalized == "":
+            return []
+
+        found = [idx for idx in self.by_normalized.get(normalized, []) if in_namespace(idx)]
+        if found or self.threshold >= 1:
+            return [self.entries[idx][0] for idx in found]
+
+        trigrams = get_trigrams(normalized)
+        nq = len(trigrams)
+        # bounds of the length filtering (with a tolerance for the float rounding)
+        min_len = max(1, math.ceil(self.threshold * nq - 1e-9))
+        max_len = math.floor(nq / self.threshold + 1e-9)
+
+        # prefix filtering: a candidate with c trigrams must share at least
+        # o(c) = ceil(t*(q+c)/(1+t)) trigrams with the query, all among the k
+        # query trigrams in the index, so it contains at least e+1 of the
+        # k - o(c) + 1 + e rarest of them. The i-th rarest trigram is scanned
+        # only for the names with o(c) <= k - i + e (the longer names need
+        # more shared trigrams, so fewer rare trigrams are scanned for them)
+        # and the names with less than e+1 hits are discarded
+        ratio = self.threshold / (1 + self.threshold)
+        known = [t for t in trigrams if t in self.by_trigram]
+        known.sort(key=lambda t: len(self.by_trigram[t][1]))
+        nk = len(known)
+        e = self.PREFIX_EXTRA
+        hits = Counter()
+        for i, t in enumerate(known):
+            max_len_i = min(max_len, math.floor((nk - i + e) / ratio - nq + 1e-9))
+            if max_len_i < min_len:
+                break
+            lengths, idxs = self.by_trigram[t]
+            hits.update(idxs[bisect_left(lengths, min_len):bisect_right(lengths, max_len_i)])
+
+        # hits required for a name with c trigrams: e+1,
+        # or o(c) if all the k trigrams are scanned for it
+        required = dict()
+        candidates = []
+        for idx, n in hits.items():
+            c = self.entries[idx][2]
+            r = required.get(c)
+            if r is None:
+                o = math.ceil(ratio * (nq + c) - 1e-9)
+                r = required[c] = min(o, e + 1)
+            if n >= r:
+                candidates.append(idx)
+
+        best = self.threshold
+        found = []
+        for idx in sorted(candidates):
+            entry = self.entries[idx]
+            if not in_namespace(idx):
+                continue
+            n = len(trigrams & entry[3])
+            similarity = n / (nq + entry[2] - n)
+            if similarity > best:
+                best = similarity
+                found = [idx]
+            elif similarity == best:
+                found.append(idx)
+        return [self.entries[idx][0] for idx in found]
+
 # returns a price for the comodity with currency and date (only date, no time)
 # returns None if not found
 def find_price(book, commodity, currency, dtime):
+    # the date is compared in local time, as the engine does
+    # (naive datetimes are already local time)
+    date = dtime.astimezone().date()
+    # the prices are sorted newest first: stop at the first older date
     prices = book.get_price_db().get_prices(commodity, currency)
     for price in prices:
-        price_datetime = price.get_time64()
-        if price_datetime.date() == dtime.date():
+        price_date = price.get_time64().date()
+        if price_date == date:
             return price
+        if price_date < date:
+            break
     return None
 
 def add_price(book, value, date, currency_str="EUR", 
               commodity_isin="", commodity_fullname="", commodity_namespace="",
+              fullname_index=None,
               ):
     # returns: 
     #   commodity: the commodity (eventually) updated 
@@ -116,6 +293,10 @@ def add_price(book, value, date, currency_str="EUR",
     #     False: skipped because the price already exists
     #
     # exceptions: yessss
+    #
+    # fullname_index: if not None, the FullnameIndex used to search 
+    #   the commodity by exact, normalized or fuzzy fullname; 
+    #   ambiguous matches (also exact ones) raise a LookupError
 
     def string_has_content(s):
         return (isinstance(s, str) and len(s)>0)
@@ -151,7 +332,16 @@ def add_price(book, value, date, currency_str="EUR",
 
     # get the commodity by fullname (if needed)
     if commodity is None:
-        commodity = get_commodity_by_fullname(commodity_table, commodity_fullname, commodity_namespace)
+        if fullname_index is None:
+            commodity = get_commodity_by_fullname(commodity_table, commodity_fullname, commodity_namespace)
+        else:
+            commodities = fullname_index.find(commodity_fullname, commodity_namespace)
+            if len(commodities) > 1:
+                raise LookupError("Commodity with name=\"{0}\" is ambiguous: {1}".format(
+                    commodity_fullname, 
+                    ", ".join("\"{0}\" ({1})".format(c.get_fullname(), c.get_namespace()) for c in commodities)))
+            if commodities:
+                commodity = commodities[0]
         if commodity is None: 
             if has_namespace:
                 raise LookupError("Commodity with name=\"{0}\" and namespace=\"{1}\" not found".format(commodity_fullname, commodity_namespace))
@@ -182,9 +372,45 @@ def add_price(book, value, date, currency_str="EUR",
     return commodity, True
 
 
+@contextmanager
+def bulk_insert(book):
+    """Bulk insert context
+
+    Suspends the QOF events and wraps all the prices added in the block
+    in a single price DB edit, in bulk update mode: the engine skips its
+    own check for a price of the same local day, to be replaced by the new one.
+    This is safe as add_price already looks for a price of the same
+    local day with find_price, and skips or rejects the new one.
+    The previous state is restored even if the block raises an exception,
+    so the caller can still rollback by not saving the session.
+
+    If the bindings do not export qof_event_suspend/qof_event_resume
+    (QOF_EVENTS_SUSPENDABLE is False) the events are not suspended
+    and a RuntimeWarning is issued."""
+
+    if not QOF_EVENTS_SUSPENDABLE:
+        warnings.warn("qof_event_suspend not available in the gnucash bindings: events not suspended",
+                      RuntimeWarning, stacklevel=3)
+
+    pricedb = book.get_price_db()
+    qof_event_suspend()
+    try:
+        pricedb.begin_edit()
+        try:
+            pricedb.set_bulk_update(True)
+            try:
+                yield pricedb
+            finally:
+                pricedb.set_bulk_update(False)
+        finally:
+            pricedb.commit_edit()
+    finally:
+        qof_event_resume()
+
+
 # try to insert the quotes and print the result of each operation
 # returns the number of errors
-def do_insert_prices(book, quotes):
+def do_insert_prices(book, quotes, fuzzy_threshold=None):
     # quotes is an array of dict. each dict must have fields (* = mandatory)
     # *Date: 2020-09-11T00:00:00+02:00
     # *Isin: 
@@ -192,6 +418,13 @@ def do_insert_prices(book, quotes):
     #  StockName:
     #  Currency: default "EUR"
     #  Namespace: default ""
+    #
+    # fuzzy_threshold: if not None, the names not found are searched 
+    #   by normalized/fuzzy match with the given similarity threshold
+
+    fullname_index = None
+    if fuzzy_threshold is not None:
+        fullname_index = FullnameIndex(book.get_table(), fuzzy_threshold)
 
     errors = 0
     row = 0
@@ -228,7 +461,8 @@ def do_insert_prices(book, quotes):
                 book, price, date, currency_str, 
                 commodity_isin=isin, 
                 commodity_fullname=fullname, 
-                commodity_namespace=namespace_name)
+                commodity_namespace=namespace_name,
+                fullname_index=fullname_index)
             if added:
                 print("ADD : (commodity={0}, price={1:.3f} {2}, date={3})".format(c.get_cusip(), price, currency_str, date))
             else:
@@ -240,13 +474,171 @@ def do_insert_prices(book, quotes):
     return errors
 
 
-def insert_prices(gnucash_file, json_file, tty_enabled=False):
+# fields read from the csv file: the quote fields and
+# the "source" field, shown in the IGN messages as for the json file
+CSV_FIELDS = ("isin", "name", "date", "price", "currency", "namespace", "source")
+
+
+class CsvRow:
+    """Read-only view of a row of CsvQuotes
+
+    Behaves like the quote dict read from the json file
+    (`in`, `get`, `[]` and iteration over the fields),
+    without allocating a dict for each row."""
+
+    __slots__ = ("_quotes", "_index")
+
+    def __init__(self, quotes, index=0):
+        self._quotes = quotes
+        self._index = index
+
+    def __contains__(self, key):
+        return self._quotes.value(key, self._index) is not None
+
+    def __getitem__(self, key):
+        v = self._quotes.value(key, self._index)
+        if v is None:
+            raise KeyError(key)
+        return v
+
+    def __iter__(self):
+        for key in self._quotes.fields:
+            if key in self:
+                yield key
+
+    def get(self, key, default=None):
+        v = self._quotes.value(key, self._index)
+        return default if v is None else v
+
+
+class CsvQuotes:
+    """Quotes read from a CSV/TSV file, stored column-wise
+
+    The string columns are lists of (interned) str, with None for
+    the empty cells; the price column is an array of doubles, with NaN
+    for the empty cells, and a flag for each row set if the price is
+    an integer (returned as int, as the json file would).
+    The fields are kept in the header order.
+    Iterating yields a new CsvRow view for each row."""
+
+    def __init__(self, fields):
+        self.fields = tuple(f for f in dict.fromkeys(fields) if f in CSV_FIELDS)
+        self.columns = {f: [] for f in self.fields if f != "price"}
+        self.prices = array('d') if "price" in self.fields else None
+        self.price_is_int = bytearray()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for index in range(self.size):
+            yield CsvRow(self, index)
+
+    def value(self, key, index):
+        if key == "price":
+            if self.prices is None:
+                return None
+            v = self.prices[index]
+            if math.isnan(v):
+                return None
+            return int(v) if self.price_is_int[index] else v
+        column = self.columns.get(key)
+        if column is None:
+            return None
+        return column[index]
+
+
+def get_csv_delimiter(csv_file):
+    "Returns the delimiter of the csv file: tab for .tsv/.tab files, comma otherwise"
+    ext = splitext(csv_file)[1].lower()
+    if ext in [".tsv", ".tab"]:
+        return "\t"
+    return ","
+
+
+def read_csv_quotes(csv_file, delimiter=None):
+    """Read the quotes from a CSV/TSV file
+
+    The first line is the header with the field names (same as the json
+    file), other columns are ignored. Empty cells are missing fields.
+    The rows are parsed column-wise into a CsvQuotes.
+
+    The file is read by the (C) csv reader through a buffered text file:
+    the reader needs str lines, so memory-mapping the file would only add
+    a decode and a copy for each line."""
+
+    if delimiter is None:
+        delimiter = get_csv_delimiter(csv_file)
+
+    with open(csv_file, "r", encoding="utf-8-sig", newline="") as f:
+        reader = csv.reader(f, delimiter=delimiter)
+
+        header = next(reader, None)
+        if header is None:
+            raise ValueError("header not found")
+        header = [h.strip().lower() for h in header]
+
+        quotes = CsvQuotes(header)
+        # (column index, column list) of the string fields
+        targets = [(header.index(f), quotes.columns[f]) for f in quotes.columns]
+        price_index = header.index("price") if quotes.prices is not None else None
+
+        # intern the repeated values (currency, namespace, ...)
+        interned = dict()
+        nan = float("nan")
+
+        for cells in reader:
+            if not cells:
+                continue
+            quotes.size += 1
+            ncells = len(cells)
+
+            for idx, column in targets:
+                v = cells[idx].strip() if idx < ncells else ""
+                if v == "":
+                    column.append(None)
+                else:
+                    column.append(interned.setdefault(v, v))
+
+            if price_index is not None:
+                v = cells[price_index].strip() if price_index < ncells else ""
+                if v == "":
+                    quotes.prices.append(nan)
+                    quotes.price_is_int.append(0)
+                else:
+                    try:
+                        price = float(v)
+                    except ValueError:
+                        price = nan
+                    # NaN is the missing price: reject nan/inf values
+                    if not math.isfinite(price):
+                        raise ValueError("invalid price \"{0}\" at row {1}".format(v, quotes.size))
+                    quotes.prices.append(price)
+                    quotes.price_is_int.append(v.lstrip("+-").isdigit())
+
+    return quotes
+
+
+def insert_prices(gnucash_file, json_file, tty_enabled=False, csv_file=None, fuzzy_threshold=None):
     
     if not isfile(gnucash_file):
         print("gnucash_file not found")
         return
 
-    if json_file is None:
+    if csv_file is not None:
+
+        if not isfile(csv_file):
+            print("csv_file not found")
+            return
+
+        try:
+            quotes = read_csv_quotes(csv_file)
+        except Exception as err:
+            print("Error reading csv file: %s" % err)
+            return
+
+    elif json_file is None:
         if (not tty_enabled) and sys.stdin.isatty():
             print("Error: json expected from file or stdin")
             return
@@ -271,7 +663,8 @@ def insert_prices(gnucash_file, json_file, tty_enabled=False):
     session = None
     try:
         session = Session(gnucash_file, ignore_lock=False)
-        errs = do_insert_prices(session.book, quotes)
+        with bulk_insert(session.book):
+            errs = do_insert_prices(session.book, quotes, fuzzy_threshold)
         if errs == 0:
             print()
             print("No errors found: Commit")
@@ -287,17 +680,32 @@ def insert_prices(gnucash_file, json_file, tty_enabled=False):
 
 
 
+def similarity_threshold(s):
+    "Argument type of the similarity threshold: a float in (0, 1]"
+    try:
+        threshold = float(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid float value: '{0}'".format(s))
+    if not (0 < threshold <= 1):
+        raise argparse.ArgumentTypeError("must be in (0, 1], got {0}".format(s))
+    return threshold
+
+
 def main_cmd():
     """Main command
     
     Handle command line arguments and call insert prices"""
 
     # Create a parser
-    parser = argparse.ArgumentParser(description='Insert gnucash quote prices from a json file')
+    parser = argparse.ArgumentParser(description='Insert gnucash quote prices from a json or csv file')
 
     # Add argument
     parser.add_argument('gnucash_file', help="the gnucash file to be updated")  
-    parser.add_argument('-j', '--json_file', help="the json file containing the new quotes (default stdin)")
+    quotes_file = parser.add_mutually_exclusive_group()
+    quotes_file.add_argument('-j', '--json_file', help="the json file containing the new quotes (default stdin)")
+    quotes_file.add_argument('-c', '--csv_file', help="the csv/tsv file containing the new quotes")
+    parser.add_argument('--fuzzy', dest="fuzzy_threshold", type=similarity_threshold, metavar="THRESHOLD",
+        help="search the names not found by normalized/fuzzy match with the given similarity threshold in (0, 1]")
     parser.add_argument( '--tty', dest="tty", action="store_true", help="enable an interactive json file stream")
     # parser.add_argument( '--no-tty', dest="tty", action="store_false", help="disable an interactive json file stream")
     parser.set_defaults(tty=False)
@@ -310,7 +718,7 @@ def main_cmd():
     # print(parser.format_help())
     # print(args.gnucash_file)
     
-    insert_prices(args.gnucash_file, args.json_file)
+    insert_prices(args.gnucash_file, args.json_file, csv_file=args.csv_file, fuzzy_threshold=args.fuzzy_threshold)
 
 
 if __name__ == '__main__':
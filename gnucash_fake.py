@@ -0,0 +1,360 @@
+"""In-memory stand-in for the GnuCash Python bindings
+
+Implements the subset of Session, book, commodity table, price DB,
+GncPrice and GncNumeric used by gnucash-insert-prices.py and its tests,
+so they can run (and be profiled on large synthetic books) without
+the native bindings and without the XML backend.
+
+The book is kept in memory and pickled to the session file by save().
+
+Select it setting the environment variable GNUCASH_BINDINGS=fake."""
+
+from bisect import bisect_right
+import datetime
+from fractions import Fraction
+from os.path import isfile
+import pickle
+
+
+class GnuCashBackendException(Exception):
+    pass
+
+
+# <QOF-EVENTS>
+_event_suspend_count = 0
+
+
+def qof_event_suspend():
+    global _event_suspend_count
+    _event_suspend_count += 1
+
+
+def qof_event_resume():
+    global _event_suspend_count
+    if _event_suspend_count > 0:
+        _event_suspend_count -= 1
+
+
+def qof_event_is_suspended():
+    return _event_suspend_count > 0
+# </QOF-EVENTS>
+
+
+class GncNumeric:
+    """Rational number: GncNumeric(num, denom) or GncNumeric(value)
+
+    Float values are converted to the nearest fraction
+    with denominator up to 10**9."""
+
+    def __init__(self, num=0, denom=1):
+        if isinstance(num, float):
+            f = Fraction(num).limit_denominator(10**9)
+        else:
+            f = Fraction(num, denom)
+        self.num = f.numerator
+        self.denom = f.denominator
+
+    def to_double(self):
+        return self.num / self.denom
+
+    def to_string(self):
+        return "%d/%d" % (self.num, self.denom)
+
+    def __repr__(self):
+        return "GncNumeric(%d, %d)" % (self.num, self.denom)
+
+
+class GncCommodity:
+
+    def __init__(self, book=None, fullname="", commodity_namespace="", mnemonic="", cusip="", fraction=1):
+        self._fullname = fullname
+        self._namespace = commodity_namespace
+        self._mnemonic = mnemonic
+        self._cusip = cusip
+        self._fraction = fraction
+
+    def get_fullname(self):
+        return self._fullname
+
+    def get_namespace(self):
+        return self._namespace
+
+    def get_mnemonic(self):
+        return self._mnemonic
+
+    def get_cusip(self):
+        return self._cusip
+
+    def get_fraction(self):
+        return self._fraction
+
+    def __repr__(self):
+        return "GncCommodity(%s::%s)" % (self._namespace, self._mnemonic)
+
+
+class GncCommodityNamespace:
+
+    def __init__(self, name):
+        self._name = name
+        # mnemonic -> commodity
+        self._commodities = dict()
+
+    def get_name(self):
+        return self._name
+
+
+# default namespaces and currencies of a new book
+DEFAULT_NAMESPACES = ["AMEX", "NYSE", "NASDAQ", "EUREX", "FUND", "template"]
+
+CURRENCY_NAMESPACE = "CURRENCY"
+
+# (mnemonic, fullname, ISO 4217 numeric code)
+CURRENCIES = [
+    ("AUD", "Australian Dollar", "036"),
+    ("CAD", "Canadian Dollar", "124"),
+    ("CHF", "Swiss Franc", "756"),
+    ("CNY", "Yuan Renminbi", "156"),
+    ("DEM", "German Mark", "276"),
+    ("DKK", "Danish Krone", "208"),
+    ("EUR", "Euro", "978"),
+    ("FRF", "French Franc", "250"),
+    ("GBP", "Pound Sterling", "826"),
+    ("ITL", "Italian Lira", "380"),
+    ("JPY", "Yen", "392"),
+    ("NOK", "Norwegian Krone", "578"),
+    ("SEK", "Swedish Krona", "752"),
+    ("USD", "US Dollar", "840"),
+]
+
+
+class GncCommodityTable:
+    """Commodity table: namespaces and commodities are stored in dicts,
+    so lookup and insert do not depend on the size of the table"""
+
+    def __init__(self, book=None):
+        # namespace name -> namespace
+        self._namespaces = dict()
+        for name in DEFAULT_NAMESPACES:
+            self.add_namespace(name)
+        for mnemonic, fullname, code in CURRENCIES:
+            self.insert(GncCommodity(book, fullname, CURRENCY_NAMESPACE, mnemonic, code, 100))
+
+    @staticmethod
+    def _namespace_name(name):
+        # ISO4217 is the legacy name of the currency namespace
+        return CURRENCY_NAMESPACE if name == "ISO4217" else name
+
+    def add_namespace(self, name, book=None):
+        name = self._namespace_name(name)
+        ns = self._namespaces.get(name)
+        if ns is None:
+            ns = GncCommodityNamespace(name)
+            self._namespaces[name] = ns
+        return ns
+
+    def find_namespace(self, name):
+        return self._namespaces.get(self._namespace_name(name))
+
+    def get_namespaces(self):
+        return list(self._namespaces)
+
+    def get_namespaces_list(self):
+        return list(self._namespaces.values())
+
+    def get_commodities(self, name):
+        ns = self.find_namespace(name)
+        if ns is None:
+            return []
+        return list(ns._commodities.values())
+
+    def lookup(self, name, mnemonic):
+        ns = self.find_namespace(name)
+        if ns is None:
+            return None
+        return ns._commodities.get(mnemonic)
+
+    def insert(self, commodity):
+        "Inserts the commodity; returns the commodity already in the table, if any"
+        ns = self.add_namespace(commodity.get_namespace())
+        return ns._commodities.setdefault(commodity.get_mnemonic(), commodity)
+
+    def get_size(self):
+        return sum(len(ns._commodities) for ns in self._namespaces.values())
+
+
+class GncPrice:
+
+    def __init__(self, book=None, instance=None):
+        self._commodity = None
+        self._currency = None
+        self._time64 = 0
+        self._value = GncNumeric()
+        self._source = 0
+
+    def set_commodity(self, commodity):
+        self._commodity = commodity
+
+    def get_commodity(self):
+        return self._commodity
+
+    def set_currency(self, currency):
+        self._currency = currency
+
+    def get_currency(self):
+        return self._currency
+
+    def set_time64(self, dtime):
+        # as the bindings: stored as seconds since the epoch
+        # (naive datetimes are local time) and returned as naive local time
+        self._time64 = int(dtime.timestamp())
+
+    def get_time64(self):
+        return datetime.datetime.fromtimestamp(self._time64)
+
+    def set_value(self, value):
+        self._value = value
+
+    def get_value(self):
+        return self._value
+
+    def set_source(self, source):
+        self._source = source
+
+    def get_source(self):
+        return self._source
+
+
+class GncPriceDB:
+    """Price DB: the prices are stored in a dict keyed by (commodity, currency).
+
+    Each price list is kept newest first by inserting with bisect on
+    a parallel list of the negated time64 keys; get_prices returns the list
+    itself, without copying, so it must not be modified by the caller."""
+
+    def __init__(self):
+        # (commodity, currency) -> (negated time64 keys, prices)
+        self._prices = dict()
+        self._num_prices = 0
+        self._editlevel = 0
+        self._bulk_update = False
+
+    def begin_edit(self):
+        self._editlevel += 1
+
+    def commit_edit(self):
+        if self._editlevel <= 0:
+            raise GnuCashBackendException("commit_edit without begin_edit")
+        self._editlevel -= 1
+
+    def set_bulk_update(self, bulk_update):
+        self._bulk_update = bool(bulk_update)
+
+    def add_price(self, price):
+        """Adds the price; as the engine, out of bulk update a price
+        of the same local day is replaced (or kept, if its source
+        has higher priority, i.e. a lower value)"""
+        key = (price.get_commodity(), price.get_currency())
+        entry = self._prices.get(key)
+        if entry is None:
+            entry = self._prices[key] = ([], [])
+        keys, prices = entry
+        if not self._bulk_update:
+            idx = self._find_day(keys, price._time64)
+            if idx is not None:
+                if price.get_source() > prices[idx].get_source():
+                    return True
+                del keys[idx]
+                del prices[idx]
+                self._num_prices -= 1
+        # after the prices with the same time
+        idx = bisect_right(keys, -price._time64)
+        keys.insert(idx, -price._time64)
+        prices.insert(idx, price)
+        self._num_prices += 1
+        return True
+
+    @staticmethod
+    def _find_day(keys, time64):
+        # index of the newest price of the local day of time64, if any
+        day = datetime.datetime.fromtimestamp(time64).date()
+        start = datetime.datetime.combine(day, datetime.time())
+        end = start + datetime.timedelta(days=1)
+        idx = bisect_right(keys, -int(end.timestamp()))
+        if idx < len(keys) and keys[idx] <= -int(start.timestamp()):
+            return idx
+        return None
+
+    def get_prices(self, commodity, currency):
+        entry = self._prices.get((commodity, currency))
+        if entry is None:
+            return []
+        return entry[1]
+
+    def get_num_prices(self):
+        return self._num_prices
+
+
+class Account:
+
+    def __init__(self, book=None):
+        self._name = ""
+        self._type = 0
+
+    def SetName(self, name):
+        self._name = name
+
+    def GetName(self):
+        return self._name
+
+    def SetType(self, acct_type):
+        self._type = acct_type
+
+    def GetType(self):
+        return self._type
+
+
+class Book:
+
+    def __init__(self):
+        self._table = GncCommodityTable(self)
+        self._pricedb = GncPriceDB()
+        self._root_account = None
+
+    def get_table(self):
+        return self._table
+
+    def get_price_db(self):
+        return self._pricedb
+
+    def set_root_account(self, account):
+        self._root_account = account
+
+    def get_root_account(self):
+        return self._root_account
+
+
+class Session:
+
+    def __init__(self, book_uri=None, mode=None, instance=None, book=None,
+                 ignore_lock=False, is_new=False, force_new=False):
+        path = book_uri or ""
+        if "://" in path:
+            path = path.split("://", 1)[1]
+        self._path = path
+
+        if is_new:
+            if isfile(path) and not force_new:
+                raise GnuCashBackendException("File {0} already exists".format(path))
+            self.book = Book()
+        else:
+            if not isfile(path):
+                raise GnuCashBackendException("File {0} not found".format(path))
+            with open(path, "rb") as f:
+                self.book = pickle.load(f)
+
+    def save(self):
+        with open(self._path, "wb") as f:
+            pickle.dump(self.book, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def end(self):
+        self.book = None
@@ -2,13 +2,26 @@ import unittest
 from unittest.mock import patch 
 from io import StringIO 
 
-from gnucash import (
-        Session, Account, Transaction, Split, GncNumeric, GncCommodity
-)
+import os
+
+# in-memory stand-in for the bindings (see gnucash_fake.py)
+import gnucash_fake
+
+FAKE_BINDINGS = os.environ.get("GNUCASH_BINDINGS") == "fake"
+
+if FAKE_BINDINGS:
+    from gnucash_fake import (
+            Session, Account, GncNumeric, GncCommodity
+    )
+else:
+    from gnucash import (
+            Session, Account, Transaction, Split, GncNumeric, GncCommodity
+    )
 
 import datetime
 import sys
 import glob
+import time
 
 # <unittest-for-scripts> 
 # How do I write Python unit tests for scripts
@@ -282,6 +295,78 @@ class TestGnucash(unittest.TestCase):
             script.add_price(self.book, value, date, commodity_fullname=fullname)
         # print(cm.exception)
 
+    def test_fullname_index(self):
+        # normalized match only
+        index = script.FullnameIndex(self.comm_table)
+        commodities = index.find("test  COMMODITY-1")
+        self.assertEqual([c.get_cusip() for c in commodities], [get_commodity_isin(1)])
+        self.assertEqual(index.find("Test comodity 1"), [])
+        self.assertEqual(index.find("test commodity 1", "UNKNOWN"), [])
+
+        # fuzzy match
+        index = script.FullnameIndex(self.comm_table, 0.5)
+        commodities = index.find("Test comodity 1", COMMODITY_NAMESPACE)
+        self.assertEqual([c.get_cusip() for c in commodities], [get_commodity_isin(1)])
+
+        # ambiguous match
+        commodities = index.find("Test commodity")
+        self.assertEqual(len(commodities), 3)
+
+        with self.assertRaises(ValueError):
+            script.FullnameIndex(self.comm_table, 0)
+
+    def test_add_price_by_fuzzy_fullname(self):
+        value = 33.3
+        date = datetime.datetime(2020, 5, 5)
+        index = script.FullnameIndex(self.comm_table, 0.5)
+
+        # exact match fails, fuzzy match found
+        comm, added = script.add_price(self.book, value, date,
+            commodity_fullname="TEST comodity-3", fullname_index=index)
+        self.assertTrue(added, "1 Skipped unexpected!")
+        self.assertEqual(comm.get_cusip(), get_commodity_isin(3))
+
+        # without the index the name is not found
+        with self.assertRaises(LookupError):
+            script.add_price(self.book, value, date, commodity_fullname="TEST comodity-3")
+
+        # ambiguous match
+        with self.assertRaisesRegex(LookupError, "is ambiguous"):
+            script.add_price(self.book, value, date,
+                commodity_fullname="Test commodity", fullname_index=index)
+
+    def test_add_price_by_fullname_in_two_namespaces(self):
+        session = init_gnucash_file(FILE_PREFIX + "-ambiguous.gnucash")
+        book = session.book
+        for namespace in ["NYSE", "NASDAQ"]:
+            book.get_table().insert(gnc_commodity_new(
+                book, "Acme Corp", namespace, "ACME", "ACME" + namespace, 1000))
+
+        value = 55.5
+        date = datetime.datetime(2020, 6, 6)
+        index = script.FullnameIndex(book.get_table())
+
+        # exact duplicates are ambiguous too
+        for fullname in ["Acme Corp", "acme corp"]:
+            with self.assertRaisesRegex(LookupError, "is ambiguous: \"Acme Corp\" \\(NYSE\\), \"Acme Corp\" \\(NASDAQ\\)"):
+                script.add_price(book, value, date,
+                    commodity_fullname=fullname, fullname_index=index)
+
+        # not ambiguous within a namespace
+        comm, added = script.add_price(book, value, date,
+            commodity_fullname="Acme Corp", commodity_namespace="NASDAQ", fullname_index=index)
+        self.assertTrue(added, "Skipped unexpected!")
+        self.assertEqual(comm.get_cusip(), "ACMENASDAQ")
+
+        session.end()
+
+    def test_similarity_threshold(self):
+        self.assertEqual(script.similarity_threshold("0.8"), 0.8)
+        self.assertEqual(script.similarity_threshold("1"), 1.0)
+        for s in ["0", "1.5", "-0.1", "abc"]:
+            with self.assertRaises(script.argparse.ArgumentTypeError):
+                script.similarity_threshold(s)
+
     def test_do_insert_prices(self):
 
         def quote(iter):
@@ -303,6 +388,241 @@ class TestGnucash(unittest.TestCase):
             errs = script.do_insert_prices(self.book, quotes)
             self.assertEqual(errs, 0)
 
+    def assertBulkState(self, in_bulk):
+        # the engine state is only inspectable with the fake bindings
+        if not FAKE_BINDINGS:
+            return
+        pricedb = self.book.get_price_db()
+        self.assertEqual(gnucash_fake.qof_event_is_suspended(), in_bulk)
+        self.assertEqual(pricedb._editlevel, 1 if in_bulk else 0)
+        self.assertEqual(pricedb._bulk_update, in_bulk)
+
+    def test_bulk_insert(self):
+        date = datetime.datetime(2020, 4, 4)
+        isin = get_commodity_isin(3)
+        pricedb = self.book.get_price_db()
+        num_prices = pricedb.get_num_prices()
+
+        with script.bulk_insert(self.book):
+            self.assertBulkState(True)
+            comm, added = script.add_price(self.book, 44.4, date, commodity_isin=isin)
+            self.assertTrue(added, "1 Skipped unexpected!")
+
+            # the price added in the same bulk must be found
+            comm, added = script.add_price(self.book, 44.4, date, commodity_isin=isin)
+            self.assertFalse(added, "2 Added unexpected!")
+        self.assertBulkState(False)
+        self.assertEqual(pricedb.get_num_prices(), num_prices + 1)
+
+        # the state must be restored and the price db usable after an error in the bulk
+        with self.assertRaises(ValueError):
+            with script.bulk_insert(self.book):
+                self.assertBulkState(True)
+                script.add_price(self.book, 44.9, date, commodity_isin=isin)
+        self.assertBulkState(False)
+
+        comm, added = script.add_price(self.book, 44.4, date, commodity_isin=isin)
+        self.assertFalse(added, "3 Added unexpected!")
+        self.assertEqual(pricedb.get_num_prices(), num_prices + 1)
+
+    def test_bulk_insert_quote_offset_not_local(self):
+        # the quote offset (+02:00) differs from the local time zone:
+        # a re-import must skip the prices, not add duplicates
+        session = init_gnucash_file(FILE_PREFIX + "-tz.gnucash")
+        book = session.book
+        quotes = [{"isin": get_commodity_isin(1), "date": "2020-10-11T00:00:00+02:00", "price": 10.01}]
+        commodity = book.get_table().lookup("TEST", "TEST1")
+        currency = book.get_table().lookup("ISO4217", "EUR")
+
+        old_tz = os.environ.get("TZ")
+        os.environ["TZ"] = "UTC"
+        time.tzset()
+        try:
+            for expected in ["ADD : ", "SKIP: "]:
+                with patch('sys.stdout', new = StringIO()) as fake_out:
+                    with script.bulk_insert(book):
+                        errs = script.do_insert_prices(book, quotes)
+                    self.assertEqual(errs, 0)
+                    self.assertRegex(fake_out.getvalue(), "^" + expected)
+            self.assertEqual(len(book.get_price_db().get_prices(commodity, currency)), 1)
+        finally:
+            if old_tz is None:
+                del os.environ["TZ"]
+            else:
+                os.environ["TZ"] = old_tz
+            time.tzset()
+            session.end()
+
+
+class TestGnucashSyntheticBook(unittest.TestCase):
+    # synthetic book with many commodities and prices:
+    # with GNUCASH_BINDINGS=fake the sizes can be increased to profile
+    # the resolution and duplicate-check logic on large books
+
+    NUM_COMMODITIES = 200
+    NUM_DAYS = 20
+
+    def test_do_insert_prices_synthetic_book(self):
+        session = init_gnucash_file(FILE_PREFIX + "-synthetic.gnucash")
+        book = session.book
+        for num in range(4, self.NUM_COMMODITIES + 1):
+            insert_test_commodity(book, num)
+
+        # local midnight (with the local offset, as the date format requires):
+        # the same calendar day as the stored price
+        day0 = datetime.datetime(2021, 1, 1)
+        quotes = []
+        for day in range(self.NUM_DAYS):
+            for num in range(1, self.NUM_COMMODITIES + 1):
+                quotes.append({
+                    "isin": get_commodity_isin(num),
+                    "date": (day0 + datetime.timedelta(days=day)).astimezone().isoformat(),
+                    "price": num + day/100.0,
+                })
+
+        with patch('sys.stdout', new = StringIO()) as fake_out:
+            with script.bulk_insert(book):
+                errs = script.do_insert_prices(book, quotes)
+            self.assertEqual(errs, 0)
+            self.assertEqual(book.get_price_db().get_num_prices(), len(quotes))
+
+            # all skipped
+            errs = script.do_insert_prices(book, quotes)
+            self.assertEqual(errs, 0)
+            self.assertEqual(book.get_price_db().get_num_prices(), len(quotes))
+
+        session.end()
+
+    def test_fullname_index_same_as_full_scan(self):
+        # the length and prefix filtering must not lose any match
+        words = ["Global", "Euro", "Bond", "Equity", "Index", "Fund", "Growth",
+                 "Income", "Small", "Cap", "Value", "ESG", "Acc", "Dist"]
+        table = gnucash_fake.Book().get_table()
+        for num in range(self.NUM_COMMODITIES):
+            fullname = " ".join(words[(num * k) % len(words)] for k in range(1, 5)) + " %d" % num
+            table.insert(gnucash_fake.GncCommodity(None, fullname, "FUND", "F%d" % num, "", 10000))
+
+        # names with a typo, a missing word and a different number
+        fullnames = [c.get_fullname() for c in table.get_commodities("FUND")]
+        queries = [name[:5] + name[6:] for name in fullnames[::20]]
+        queries += [name.split(" ", 1)[1] for name in fullnames[5::20]]
+        queries += [name.rsplit(" ", 1)[0] + " 1000" for name in fullnames[10::20]]
+        for threshold in (0.3, 0.5, 0.8, 0.95):
+            index = script.FullnameIndex(table, threshold)
+            for query in queries:
+                trigrams = script.get_trigrams(script.normalize_fullname(query))
+                best, expected = threshold, []
+                for commodity, _, _, entry_trigrams in index.entries:
+                    n = len(trigrams & entry_trigrams)
+                    similarity = n / (len(trigrams) + len(entry_trigrams) - n)
+                    if similarity > best: best = similarity; expected = [commodity]
+                    elif similarity == best: expected.append(commodity)
+                self.assertEqual(set(index.find(query)), set(expected), (threshold, query))
+
+
+class TestGnucashFake(unittest.TestCase):
+    # the in-memory stand-in itself (pure Python, always available)
+
+    def test_gnc_numeric_from_float(self):
+        n = gnucash_fake.GncNumeric(10.01)
+        self.assertEqual((n.num, n.denom), (1001, 100))
+        self.assertEqual(n.to_double(), 10.01)
+
+        n = gnucash_fake.GncNumeric(3, 6)
+        self.assertEqual((n.num, n.denom), (1, 2))
+
+    def test_commit_edit_without_begin_edit(self):
+        pricedb = gnucash_fake.GncPriceDB()
+        pricedb.begin_edit()
+        pricedb.commit_edit()
+        with self.assertRaises(gnucash_fake.GnuCashBackendException):
+            pricedb.commit_edit()
+
+    def test_get_prices_newest_first(self):
+        book = gnucash_fake.Book()
+        table = book.get_table()
+        commodity = table.insert(gnucash_fake.GncCommodity(book, "Fake", "TEST", "FAKE", "FAKE0001", 1000))
+        currency = table.lookup("ISO4217", "EUR")
+        pricedb = book.get_price_db()
+
+        for day in [2, 3, 1]:
+            p = gnucash_fake.GncPrice(book)
+            p.set_time64(datetime.datetime(2020, 1, day))
+            p.set_commodity(commodity)
+            p.set_currency(currency)
+            pricedb.add_price(p)
+
+        prices = pricedb.get_prices(commodity, currency)
+        self.assertEqual([p.get_time64().day for p in prices], [3, 2, 1])
+        self.assertEqual(pricedb.get_num_prices(), 3)
+
+    def test_add_price_same_day(self):
+        book = gnucash_fake.Book()
+        table = book.get_table()
+        commodity = table.insert(gnucash_fake.GncCommodity(book, "Fake", "TEST", "FAKE", "FAKE0001", 1000))
+        currency = table.lookup("ISO4217", "EUR")
+        pricedb = book.get_price_db()
+
+        def add_price(hour, value, source=2):  # PRICE_SOURCE_USER_PRICE
+            p = gnucash_fake.GncPrice(book)
+            p.set_time64(datetime.datetime(2020, 1, 1, hour))
+            p.set_commodity(commodity)
+            p.set_currency(currency)
+            p.set_value(gnucash_fake.GncNumeric(value))
+            p.set_source(source)
+            pricedb.add_price(p)
+
+        def values():
+            return [p.get_value().to_double() for p in pricedb.get_prices(commodity, currency)]
+
+        # out of bulk update the price of the same local day is replaced
+        add_price(0, 1.0)
+        add_price(23, 2.0)
+        self.assertEqual(values(), [2.0])
+        self.assertEqual(pricedb.get_num_prices(), 1)
+
+        # unless the old one has a higher priority source
+        add_price(12, 3.0, 3)
+        self.assertEqual(values(), [2.0])
+
+        # in bulk update both are kept
+        pricedb.set_bulk_update(True)
+        add_price(12, 4.0)
+        self.assertEqual(values(), [2.0, 4.0])
+        self.assertEqual(pricedb.get_num_prices(), 2)
+
+    def test_session_save_and_reload(self):
+        path = FILE_PREFIX + "-fake.gnucash"
+
+        session = gnucash_fake.Session("xml://%s" % path, is_new=True, force_new=True)
+        book = session.book
+        table = book.get_table()
+        commodity = table.insert(gnucash_fake.GncCommodity(book, "Fake", "TEST", "FAKE", "FAKE0001", 1000))
+        p = gnucash_fake.GncPrice(book)
+        p.set_time64(datetime.datetime(2020, 1, 1))
+        p.set_commodity(commodity)
+        p.set_currency(table.lookup("ISO4217", "EUR"))
+        p.set_value(gnucash_fake.GncNumeric(12.34))
+        book.get_price_db().add_price(p)
+        session.save()
+        session.end()
+
+        with self.assertRaises(gnucash_fake.GnuCashBackendException):
+            gnucash_fake.Session(path, is_new=True)
+
+        session = gnucash_fake.Session(path)
+        table = session.book.get_table()
+        commodity = table.lookup("TEST", "FAKE")
+        self.assertEqual(commodity.get_cusip(), "FAKE0001")
+        prices = session.book.get_price_db().get_prices(commodity, table.lookup("ISO4217", "EUR"))
+        self.assertEqual(len(prices), 1)
+        self.assertEqual(prices[0].get_time64(), datetime.datetime(2020, 1, 1))
+        self.assertEqual(prices[0].get_value().to_double(), 12.34)
+        session.end()
+
+        with self.assertRaises(gnucash_fake.GnuCashBackendException):
+            gnucash_fake.Session(FILE_PREFIX + "-UNKNOWN.gnucash")
+
 
 class TestGnucashInsertPrices(unittest.TestCase):
 
@@ -414,5 +734,105 @@ class TestGnucashInsertPrices(unittest.TestCase):
             self.assertRegex( fake_out.getvalue(), "Error reading json file: Expecting value: line 1 column 1 \(char 0\)") 
 
 
+    def test_insert_prices_csv_file(self):
+        gnucash_file = FILE_PREFIX + "6.gnucash"
+        csv_file = FILE_PREFIX + "6.csv"
+
+        ses = init_gnucash_file(gnucash_file)
+        ses.save()
+        ses.end()
+
+        f = open(csv_file, 'w+')
+        f.write('isin,name,date,price,currency\n')
+        f.write(get_commodity_isin(1) + ',,2020-10-11T00:00:00+02:00,10.01,EUR\n')
+        f.write(',"' + get_commodity_fullname(2) + '",2020-10-12T00:00:00+02:00,20.02,\n')
+        f.write(get_commodity_isin(3) + ',,2020-10-13T00:00:00+02:00,,EUR\n')
+        f.close()
+
+        output = ""
+        with patch('sys.stdout', new = StringIO()) as fake_out:
+            script.insert_prices(gnucash_file, None, csv_file=csv_file)
+            output = fake_out.getvalue()
+
+        self.assertRegex( output, "ADD : \(commodity=TEST00000001, price=10.010 EUR, date=")
+        self.assertRegex( output, "ADD : \(commodity=TEST00000002, price=20.020 EUR, date=")
+        self.assertRegex( output, "IGN : price not found at row 3 \{'isin': 'TEST00000003', 'date': '2020-10-13T00:00:00\+02:00'\}")
+        self.assertRegex( output, "No errors found: Commit")
+
+
+    def test_read_csv_quotes_same_as_json(self):
+        csv_file = FILE_PREFIX + "-ign.csv"
+
+        f = open(csv_file, 'w+')
+        f.write('date,isin,price,source,extra\n')
+        f.write('2020-10-11T00:00:00+02:00,,10.01,vendor,x\n')
+        f.write('2020-10-12T00:00:00+02:00,TEST00000002,,vendor,x\n')
+        f.write('2020-10-13T00:00:00+02:00,,10,vendor,x\n')
+        f.close()
+
+        quotes = script.read_csv_quotes(csv_file)
+        json_quotes = [
+            {"date": "2020-10-11T00:00:00+02:00", "price": 10.01, "source": "vendor"},
+            {"date": "2020-10-12T00:00:00+02:00", "isin": "TEST00000002", "source": "vendor"},
+            {"date": "2020-10-13T00:00:00+02:00", "price": 10, "source": "vendor"},
+        ]
+
+        # each row is a distinct view
+        self.assertEqual([dict((k, q[k]) for k in q) for q in list(quotes)], json_quotes)
+
+        with patch('sys.stdout', new = StringIO()) as csv_out:
+            script.do_insert_prices(None, quotes)
+        with patch('sys.stdout', new = StringIO()) as json_out:
+            script.do_insert_prices(None, json_quotes)
+        self.assertEqual(csv_out.getvalue(), json_out.getvalue())
+        self.assertRegex(csv_out.getvalue(), "IGN : isin or name not found at row 1 \\{'date': '2020-10-11T00:00:00\\+02:00', 'price': 10.01, 'source': 'vendor'\\}")
+
+
+    def test_insert_prices_err_reading_empty_csv_file(self):
+        gnucash_file = FILE_PREFIX + "8.gnucash"
+        csv_file = FILE_PREFIX + "8.csv"
+
+        ses = init_gnucash_file(gnucash_file)
+        ses.save()
+        ses.end()
+
+        open(csv_file, 'w+').close()
+
+        with patch('sys.stdout', new = StringIO()) as fake_out:
+            script.insert_prices(gnucash_file, None, csv_file=csv_file)
+            self.assertRegex( fake_out.getvalue(), "Error reading csv file: header not found")
+
+
+    def test_insert_prices_err_reading_csv_file(self):
+        gnucash_file = FILE_PREFIX + "7.gnucash"
+        csv_file = FILE_PREFIX + "7.tsv"
+
+        ses = init_gnucash_file(gnucash_file)
+        ses.save()
+        ses.end()
+
+        f = open(csv_file, 'w+')
+        f.write('isin\tdate\tprice\n')
+        f.write(get_commodity_isin(1) + '\t2020-10-11T00:00:00+02:00\tINVALID\n')
+        f.close()
+
+        with patch('sys.stdout', new = StringIO()) as fake_out:
+            script.insert_prices(gnucash_file, None, csv_file=csv_file)
+            self.assertRegex( fake_out.getvalue(), "Error reading csv file: invalid price \"INVALID\" at row 1")
+
+
+    def test_read_csv_quotes_not_finite_price(self):
+        csv_file = FILE_PREFIX + "-nan.csv"
+
+        for price in ["nan", "inf", "-Infinity"]:
+            f = open(csv_file, 'w+')
+            f.write('isin,date,price\n')
+            f.write(get_commodity_isin(1) + ',2020-10-11T00:00:00+02:00,' + price + '\n')
+            f.close()
+
+            with self.assertRaisesRegex(ValueError, "invalid price \"%s\" at row 1" % price):
+                script.read_csv_quotes(csv_file)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file